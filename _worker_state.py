@@ -0,0 +1,34 @@
+from llm_utils.jsonl_utils import open_jsonl_append_fd
+
+# State of the `batch_run` worker processes. It is set once per worker by the pool initializer,
+# so tasks only carry an item index instead of the pickled item and callables.
+dataset = None
+total_items = None
+assemble_func = None
+run_func = None
+process_result_func = None
+output_path = None
+# opened with O_APPEND for lock-free appends, for the lifetime of the worker
+output_fd = None
+# results waiting to be appended to `output_path`, see `batch_utils._ResultBuffer`
+output_buffer = None
+# set by `batch_run` when a task failed, so that the remaining tasks are skipped
+cancel_event = None
+
+
+def init(
+    dataset_,
+    total_items_,
+    assemble_func_,
+    run_func_,
+    process_result_func_,
+    output_path_,
+):
+    global dataset, total_items, assemble_func, run_func, process_result_func, output_path, output_fd
+    dataset = dataset_
+    total_items = total_items_
+    assemble_func = assemble_func_
+    run_func = run_func_
+    process_result_func = process_result_func_
+    output_path = output_path_
+    output_fd = open_jsonl_append_fd(output_path)
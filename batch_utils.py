@@ -1,32 +1,40 @@
-from typing import Callable, List
-from multiprocessing import Pool
+from typing import Awaitable, Callable, List, Optional, Union
+import multiprocessing
+import multiprocessing.util
+import asyncio
+import concurrent.futures
+import queue
+import threading
 from tqdm import tqdm
+from tqdm.asyncio import tqdm as tqdm_asyncio
 import os.path as osp
-import jsonlines
-from datetime import datetime
+from itertools import islice
 import time
-from filelock import FileLock
-from llm_utils.jsonl_utils import write_jsonl
-from llm_utils.print_utils import make_printv
+from llm_utils.jsonl_utils import (
+    JsonlAppender,
+    _dumps,
+    append_jsonl_atomic,
+    clear_resume_state,
+    enumerate_unprocessed,
+    read_resume_ids,
+    write_jsonl,
+)
+from llm_utils.print_utils import NOOP, make_printv
+from llm_utils import _worker_state
+from llm_utils.shared_dataset import SharedJsonlDataset
 
 print_v = make_printv(True)
 
 
-def enumerate_resume(dataset, output_path, id_key="id"):
+def enumerate_resume(dataset, output_path, id_key="id", start_index: Optional[int] = None):
     if not osp.exists(output_path):
-        for item_id, item in enumerate(dataset):
+        clear_resume_state(output_path)
+        for item_id, item in islice(enumerate(dataset), start_index or 0, None):
             yield item_id, item
     else:
-        exist_items = []
-        with jsonlines.open(output_path) as reader:
-            for item in reader:
-                exist_items.append(item[id_key])
+        exist_items = read_resume_ids(output_path, id_key)
         print_v(f"Number of existing items: {len(exist_items)}")
-        for item_id, item in enumerate(dataset):
-            # skip items that have been processed before
-            if item[id_key] in exist_items:
-                continue
-            yield item_id, item
+        yield from enumerate_unprocessed(dataset, output_path, id_key, exist_items, start_index)
 
 
 def process_item(
@@ -37,20 +45,194 @@ def process_item(
     run_func: Callable,
     process_result_func: Callable,
     output_path: str,
+    output_queue: Optional[Union[queue.Queue, "_ResultBuffer"]] = None,
 ):
-    tt = time.time()
+    tt = time.perf_counter()
     assembled_input = assemble_func(item)
     run_result = run_func(assembled_input)
     processed_result = process_result_func(item, assembled_input, run_result)
     if processed_result is not None:
-        with FileLock(output_path + '.lock'):
-            write_jsonl(output_path, [processed_result], append=True)
-    elapsed = time.time() - tt
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if isinstance(output_queue, queue.Queue):
+            # serialized here so that a record that cannot be serialized fails its own item
+            output_queue.put(_dumps(processed_result))
+        elif output_queue is not None:
+            output_queue.put(processed_result)
+        else:
+            _append_results(output_path, [processed_result])
+    _print_completed(item_id, total_items, item, tt)
+    return processed_result
+
+
+def _append_results(output_path: str, processed_results: List, output_fd: Optional[int] = None):
+    # with `output_fd`, records are appended lock-free and only a single record too large for
+    # an atomic append goes through the file lock
+    oversized_lines = None
+    if output_fd is not None:
+        oversized_lines = append_jsonl_atomic(output_fd, processed_results)
+        if not oversized_lines:
+            return
+    # only needed on this fallback path, so it is not imported with the module
+    from filelock import FileLock
+
+    with FileLock(output_path + '.lock'):
+        if oversized_lines is None:
+            write_jsonl(output_path, processed_results, append=True)
+        else:
+            with open(output_path, "ab") as f:
+                f.writelines(oversized_lines)
+
+
+class _ResultBuffer:
+    # results of one process, appended to the output file every `flush_every` items or
+    # once `flush_interval` seconds have passed since the last flush
+    def __init__(
+        self,
+        output_path: str,
+        flush_every: int,
+        flush_interval: float = 1.0,
+        output_fd: Optional[int] = None,
+    ):
+        self.output_path = output_path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.output_fd = output_fd
+        self._pending = []
+        self._deadline = time.monotonic() + flush_interval
+
+    def put(self, processed_result):
+        self._pending.append(processed_result)
+        if len(self._pending) >= self.flush_every or time.monotonic() >= self._deadline:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            _append_results(self.output_path, self._pending, self.output_fd)
+            self._pending = []
+        self._deadline = time.monotonic() + self.flush_interval
+
+
+async def aprocess_item(
+    item_id,
+    total_items,
+    item,
+    assemble_func: Callable,
+    run_func: Callable[..., Awaitable],
+    process_result_func: Callable,
+    output_queue: asyncio.Queue,
+):
+    tt = time.perf_counter()
+    assembled_input = assemble_func(item)
+    run_result = await run_func(assembled_input)
+    processed_result = process_result_func(item, assembled_input, run_result)
+    if processed_result is not None:
+        # serialized here so that a record that cannot be serialized fails its own item
+        await output_queue.put(_dumps(processed_result))
+    _print_completed(item_id, total_items, item, tt)
+    return processed_result
+
+
+def _print_completed(item_id, total_items, item, tt):
+    if print_v is NOOP:
+        return
+    elapsed = time.perf_counter() - tt
     print_v(
-        f"{current_time} - Completed {item['id']:20} ({(item_id+1):5}/{total_items:5}), Elapsed(s): {elapsed:.6f}"
+        f"Completed {item['id']:20} ({(item_id+1):5}/{total_items:5}), Elapsed(s): {elapsed:.6f}"
     )
-    return processed_result
+
+
+def _write_queue_to_jsonl(
+    output_path: str,
+    output_queue: queue.Queue,
+    errors: List[BaseException],
+    flush_every: int = 32,
+    flush_interval: float = 1.0,
+):
+    # runs in the writer thread, its exception is re-raised by `batch_run` after joining it
+    try:
+        _write_queue_to_jsonl_file(output_path, output_queue, flush_every, flush_interval)
+    except BaseException as e:
+        errors.append(e)
+
+
+def _write_queue_to_jsonl_file(
+    output_path: str,
+    output_queue: queue.Queue,
+    flush_every: int,
+    flush_interval: float,
+):
+    # single writer: keeps the output file open and flushes every `flush_every`
+    # records or `flush_interval` seconds, until a `None` sentinel is received
+    with JsonlAppender(output_path) as writer:
+        num_pending = 0
+        deadline = time.monotonic() + flush_interval
+        while True:
+            try:
+                record = output_queue.get(timeout=flush_interval)
+            except queue.Empty:
+                writer.flush()
+                num_pending = 0
+                deadline = time.monotonic() + flush_interval
+                continue
+            if record is None:
+                break
+            writer.write_line(record)
+            num_pending += 1
+            if num_pending >= flush_every or time.monotonic() >= deadline:
+                writer.flush()
+                num_pending = 0
+                deadline = time.monotonic() + flush_interval
+
+
+async def _awrite_queue_to_jsonl(
+    output_path: str,
+    output_queue: asyncio.Queue,
+    flush_every: int = 32,
+):
+    # single writer coroutine: flushes every `flush_every` records or whenever the queue runs dry
+    with JsonlAppender(output_path) as writer:
+        num_pending = 0
+        while True:
+            record = await output_queue.get()
+            if record is None:
+                break
+            writer.write_line(record)
+            num_pending += 1
+            if num_pending >= flush_every or output_queue.empty():
+                writer.flush()
+                num_pending = 0
+
+
+def _init_worker(flush_every: int, cancel_event, *state):
+    _worker_state.init(*state)
+    _worker_state.cancel_event = cancel_event
+    _worker_state.output_buffer = _ResultBuffer(
+        _worker_state.output_path, flush_every, output_fd=_worker_state.output_fd
+    )
+    # pool workers do not run atexit handlers, finalizers run when the worker exits after `pool.close()`
+    multiprocessing.util.Finalize(None, _worker_state.output_buffer.flush, exitpriority=10)
+
+
+def _process_item_by_index(item_id):
+    # runs in a pool worker, the item and callables come from `_worker_state`
+    if _worker_state.cancel_event.is_set():
+        return None
+    return process_item(
+        item_id,
+        _worker_state.total_items,
+        _worker_state.dataset[item_id],
+        _worker_state.assemble_func,
+        _worker_state.run_func,
+        _worker_state.process_result_func,
+        _worker_state.output_path,
+        _worker_state.output_buffer,
+    )
+
+
+def _get_pool_context():
+    # with fork, the initializer arguments are inherited by the workers instead of being pickled
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
 
 
 def batch_run(
@@ -60,9 +242,12 @@ def batch_run(
     run_func: Callable,
     process_result_func: Callable,
     output_path: str,
+    use_threads: bool = True,
+    flush_every: int = 32,
+    share_dataset: bool = False,
 ):
     """
-    Perform batch processing on a dataset using multiprocessing.
+    Perform batch processing on a dataset using a thread pool or multiprocessing.
 
     Args:
     dataset (List): The input dataset to process.
@@ -70,46 +255,184 @@ def batch_run(
     assemble_func (Callable): Function to assemble input for each task.
     run_func (Callable): Function to run for each task.
     process_result_func (Callable): Function to process the result of each task.
+    output_path (str): The jsonl file to append results to and to resume from.
+    use_threads (bool): Use a thread pool instead of processes. LLM calls are I/O bound,
+        so threads avoid forking and pickling, and `num_threads` can exceed the CPU count.
+        Processes are forked where available and receive only item indices, so `dataset`
+        must support indexing.
+    flush_every (int): Number of results buffered before they are appended to `output_path`.
+        Up to this many finished results per worker are lost if the run crashes.
+    share_dataset (bool): With processes, copy `dataset` once into a `SharedJsonlDataset`
+        that workers parse item by item, so that worker memory does not grow with the
+        dataset. The items must be json serializable. Requires `use_threads=False`, threads
+        already share `dataset`.
 
     Returns:
-    List: Processed results of batch processing.
+    List: Processed results of batch processing, in completion order.
     """
+    if share_dataset and use_threads:
+        raise ValueError("`share_dataset` requires `use_threads=False`.")
     total_items = len(dataset)
     resume_dataset = enumerate_resume(dataset, output_path)
-    if num_threads > 1:
-        with Pool(num_threads) as pool:
-            results = list(
-                tqdm(
-                    pool.starmap(
+    if num_threads > 1 and use_threads:
+        results = []
+        output_queue = queue.Queue()
+        writer_errors = []
+        writer_thread = threading.Thread(
+            target=_write_queue_to_jsonl,
+            args=(output_path, output_queue, writer_errors, flush_every),
+            daemon=True,
+        )
+        writer_thread.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+                futures = [
+                    executor.submit(
                         process_item,
-                        [
-                            (
-                                item_id,
-                                total_items,
-                                item,
-                                assemble_func,
-                                run_func,
-                                process_result_func,
-                                output_path,
-                            )
-                            for item_id, item in resume_dataset
-                        ],
-                    ),
-                    total=total_items,
-                )
-            )
+                        item_id,
+                        total_items,
+                        item,
+                        assemble_func,
+                        run_func,
+                        process_result_func,
+                        output_path,
+                        output_queue,
+                    )
+                    for item_id, item in resume_dataset
+                ]
+                try:
+                    for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                        results.append(future.result())
+                except BaseException:
+                    # do not start any more requests once an item failed or on Ctrl-C
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+        finally:
+            output_queue.put(None)
+            writer_thread.join()
+        if writer_errors:
+            raise writer_errors[0]
+    elif num_threads > 1:
+        # only the remaining items are sent, and the chunks are sized from them
+        ids = [item_id for item_id, _ in resume_dataset]
+        chunksize = max(1, len(ids) // (num_threads * 4))
+        results = []
+        shared_dataset = SharedJsonlDataset.from_items(dataset) if share_dataset else None
+        pool_context = _get_pool_context()
+        cancel_event = pool_context.Event()
+        try:
+            with pool_context.Pool(
+                num_threads,
+                initializer=_init_worker,
+                initargs=(
+                    flush_every,
+                    cancel_event,
+                    shared_dataset if shared_dataset is not None else dataset,
+                    total_items,
+                    assemble_func,
+                    run_func,
+                    process_result_func,
+                    output_path,
+                ),
+            ) as pool:
+                try:
+                    for result in tqdm(
+                        pool.imap_unordered(_process_item_by_index, ids, chunksize=chunksize),
+                        total=len(ids),
+                    ):
+                        results.append(result)
+                except BaseException:
+                    # the tasks that have not started yet are skipped
+                    cancel_event.set()
+                    raise
+                finally:
+                    # let the workers exit normally so that they flush their buffered results,
+                    # before `Pool.__exit__` terminates them
+                    pool.close()
+                    pool.join()
+        finally:
+            if shared_dataset is not None:
+                shared_dataset.close()
     else:
-        results = [
-            process_item(
+        output_buffer = _ResultBuffer(output_path, flush_every)
+        try:
+            results = [
+                process_item(
+                    item_id,
+                    total_items,
+                    item,
+                    assemble_func,
+                    run_func,
+                    process_result_func,
+                    output_path,
+                    output_buffer,
+                )
+                for item_id, item in resume_dataset
+            ]
+        finally:
+            output_buffer.flush()
+
+    return results
+
+
+async def abatch_run(
+    dataset: List,
+    num_concurrent: int,
+    assemble_func: Callable,
+    run_func: Callable[..., Awaitable],
+    process_result_func: Callable,
+    output_path: str,
+    flush_every: int = 32,
+):
+    """
+    Perform batch processing on a dataset on the running event loop.
+
+    Args:
+    dataset (List): The input dataset to process.
+    num_concurrent (int): Maximum number of tasks in flight at the same time.
+    assemble_func (Callable): Function to assemble input for each task.
+    run_func (Callable): Coroutine function to run for each task, e.g. wrapping `aget_response`.
+    process_result_func (Callable): Function to process the result of each task.
+    output_path (str): The jsonl file to append results to and to resume from.
+    flush_every (int): Number of results buffered before they are flushed to `output_path`.
+
+    Returns:
+    List: Processed results of batch processing, in dataset order.
+    """
+    total_items = len(dataset)
+    semaphore = asyncio.Semaphore(num_concurrent)
+    output_queue = asyncio.Queue()
+    writer_task = asyncio.create_task(
+        _awrite_queue_to_jsonl(output_path, output_queue, flush_every)
+    )
+
+    async def run_item(item_id, item):
+        async with semaphore:
+            return await aprocess_item(
                 item_id,
                 total_items,
                 item,
                 assemble_func,
                 run_func,
                 process_result_func,
-                output_path,
+                output_queue,
             )
-            for item_id, item in resume_dataset
-        ]
+
+    tasks = [
+        asyncio.ensure_future(run_item(item_id, item))
+        for item_id, item in enumerate_resume(dataset, output_path)
+    ]
+    try:
+        results = await tqdm_asyncio.gather(*tasks)
+    except BaseException:
+        # do not start any more requests once an item failed or on cancellation, and let the
+        # running ones settle before the writer is stopped
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        await output_queue.put(None)
+        await writer_task
 
     return results
@@ -7,13 +7,9 @@
 
 import argparse
 import os
-import yaml
 import os.path as osp
 
-from traitlets import Bool, Int, Unicode, Float
-
-# See https://traitlets.readthedocs.io/en/stable/using_traitlets.html
-from traitlets.config import Configurable
+from dataclasses import asdict, dataclass, field, fields
 
 
 from io import TextIOWrapper
@@ -21,22 +17,25 @@ from types import *
 from typing import *
 
 
+# Snapshot of the environment, read once when the config module is imported.
+_ENV = os.environ.copy()
+
+_CAST = {
+    bool: lambda v: v.lower() == "true",
+    int: int,
+    float: float,
+    str: str,
+}
+
+
 def _get_env(
     option_name: str,
     default_value: Union[bool, int, str, float],
 ) -> Union[bool, int, str, float]:
-    env_name = option_name.upper()
-    v = os.getenv(env_name, str(default_value))
-    if type(default_value) == int:
-        return int(v)
-    elif type(default_value) == bool:
-        return v.lower() == "true"
-    elif type(default_value) == float:
-        return float(v)
-    else:
-        return v
-
-
+    v = _ENV.get(option_name.upper())
+    if v is None:
+        return default_value
+    return _CAST.get(type(default_value), str)(v)
 
 
 class Parser(argparse.ArgumentParser):
@@ -46,107 +45,98 @@ class Parser(argparse.ArgumentParser):
     def error(self, message):
         raise Exception(f"Error: {message}\n")
 
-class Config(Configurable):
-    name_prefix: str = "llmutils"
-    env_prefix: str = (
+def _option(default_value, help: str):
+    return field(default=default_value, metadata={"help": help})
+
+
+@dataclass(slots=True)
+class Config:
+    name_prefix: ClassVar[str] = "llmutils"
+    env_prefix: ClassVar[str] = (
         f"{name_prefix.upper()}_"  # prefix for environment variables, you can override it in your derived class
     )
 
 
-    llm_provider = Unicode(
+    llm_provider: str = _option(
         _get_env(env_prefix + "llm_provider", "azure"),
         help="The LiteLLM API Type. See https://docs.litellm.ai/docs/",
-    ).tag(config=True)
-
-    llm_model = Unicode(
-        _get_env(env_prefix + "llm_model", "gpt-4o"), help="The LLM model", config=True
     )
 
-    llm_max_token = Int(
+    llm_model: str = _option(_get_env(env_prefix + "llm_model", "gpt-4o"), help="The LLM model")
+
+    llm_max_token: int = _option(
         _get_env(env_prefix + "llm_max_token", 1000), help="Maximum number of tokens"
-    ).tag(config=True)
+    )
 
-    llm_temperature = Float(
+    llm_temperature: float = _option(
         _get_env(env_prefix + "llm_temperature", 0.1), help="LLM temperature"
-    ).tag(config=True)
+    )
 
-    max_attempts = Int(
+    max_attempts: int = _option(
         _get_env(env_prefix + "max_attempts", 5), help="Maximum number of attempts"
-    ).tag(config=True)
+    )
 
-    debug = Bool(_get_env(env_prefix + "debug", False), help="Log LLM calls").tag(config=True)
+    debug: bool = _option(_get_env(env_prefix + "debug", False), help="Log LLM calls")
 
-    verbose = Bool(_get_env(env_prefix + "verbose", False), help="Verbose").tag(config=True)
+    verbose: bool = _option(_get_env(env_prefix + "verbose", False), help="Verbose")
 
-    log = Unicode(_get_env(env_prefix + "log", "log.yaml"), help="The log file").tag(
-        config=True
-    )
+    log: str = _option(_get_env(env_prefix + "log", "log.yaml"), help="The log file")
 
-    input_path = Unicode(
+    input_path: Optional[str] = _option(
         _get_env(env_prefix + "input_path", "input.json"),
-        allow_none=True,
         help="The input json file",
-    ).tag(config=True)
+    )
 
-    output_dir = Unicode(
+    output_dir: Optional[str] = _option(
         _get_env(env_prefix + "output_dir", "output_data"),
-        allow_none=True,
         help="The output dir",
-    ).tag(config=True)
+    )
 
-    override = Bool(
+    override: bool = _option(
         _get_env(env_prefix + "override", False),
         help="Whether override the existing result in in the output json file",
-    ).tag(config=True)
+    )
 
-    nthreads = Int(
+    nthreads: int = _option(
         _get_env(env_prefix + "nthreads", 1),
         help="number of threads",
-    ).tag(config=True)
+    )
+
+    flush_every: int = _option(
+        _get_env(env_prefix + "flush_every", 32),
+        help="number of results buffered per worker before they are written to the output file",
+    )
 
     # can be configured by yaml file and command lines
-    _user_configurable = [
-        llm_provider,
-        llm_model,
-        llm_max_token,
-        llm_temperature,
-        max_attempts,
-        debug,
-        log,
-        input_path,
-        output_dir,
-        override,
-        nthreads,
-        verbose
+    _user_configurable: ClassVar[List[str]] = [
+        "llm_provider",
+        "llm_model",
+        "llm_max_token",
+        "llm_temperature",
+        "max_attempts",
+        "debug",
+        "log",
+        "input_path",
+        "output_dir",
+        "override",
+        "nthreads",
+        "flush_every",
+        "verbose"
     ]
 
     def to_json(self) -> Dict[str, Union[int, str, bool]]:
         """Serialize the object to a JSON string."""
-        return {
-            "llm_provider": self.llm_provider,
-            "llm_model": self.llm_model,
-            "llm_max_token": self.llm_max_token,
-            "llm_temperature": self.llm_temperature,
-            "max_attempts": self.max_attempts,
-            "debug": self.debug,
-            "log": self.log,
-            "input_path": self.input_path,
-            "output_dir": self.output_dir,
-            "override": self.override,
-            "nthreads": self.nthreads,
-            "verbose": self.verbose,
-        }
+        values = asdict(self)
+        return {name: values[name] for name in self._user_configurable}
 
     def to_pretty_str(self):
         return "\n".join([f"{k:30} {v}" for k, v in self.to_json().items()])
 
     def _parser(self):
         parser = Parser(add_help=False)
-        # (Jing) I don't know why traitlets.Float needs to be accessed once before it can appear in _trait_values.
-        _ = self.llm_temperature
-        for trait in self._user_configurable:
-            name = f"--{trait.name}"
-            value = self._trait_values[trait.name]
+        for option_name in self._user_configurable:
+            name = f"--{option_name}"
+            value = getattr(self, option_name)
             t = type(value)
             if t == bool:
                 parser.add_argument(name, default=value, action="store_true")
@@ -171,6 +161,8 @@ class Config(Configurable):
         args, remain = self._yaml_parser().parse_known_args(argv)
         main_parser = self._parser()
         if args.config_yaml:
+            import yaml
+
             with open(args.config_yaml, "r", encoding="utf-8") as f:
                 cfg = yaml.safe_load(f)
                 # override the the default value for main parser
@@ -180,23 +172,25 @@ class Config(Configurable):
         # defaults will have been overridden if config file specified.
         args, unknown_args = main_parser.parse_known_args(remain)
 
-        for x in self._user_configurable:
-            self.set_trait(x.name, getattr(args, x.name))
+        for option_name in self._user_configurable:
+            setattr(self, option_name, getattr(args, option_name))
 
         return unknown_args
 
     def user_flags_help(self) -> str:
-        return "\n".join(
-            [
-                self.class_get_trait_help(x, self).replace("Config.", "")
-                for x in self._user_configurable
-            ]
-        )
+        fields_by_name = {f.name: f for f in fields(self)}
+        helps = []
+        for x in self._user_configurable:
+            f = fields_by_name[x]
+            helps.append(
+                f"--{x}=<{type(f.default).__name__}>\n    {f.metadata['help']}\n    Current: {getattr(self, x)!r}"
+            )
+        return "\n".join(helps)
 
     def user_flags(self) -> str:
         return "\n".join(
             [
-                f"  --{x.name:30} {self._trait_values[x.name]}"
+                f"  --{x:30} {getattr(self, x)}"
                 for x in self._user_configurable
             ]
         )
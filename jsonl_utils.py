@@ -1,9 +1,67 @@
 from typing import *
-import jsonlines
 import json
 import gzip
+import io
+import math
+import pickle
+import re
 import os
 import os.path as osp
+from itertools import islice
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # ISA-L accelerated drop-in replacement for gzip
+    from isal import igzip as _gzip
+except ImportError:
+    _gzip = gzip
+
+_READ_BUFFER_SIZE = 1 << 20
+_WRITE_BUFFER_SIZE = 1 << 20
+# digit runs this long may be integers that do not fit in 64 bits
+_LONG_DIGIT_RUN = re.compile(rb"\d{20,}")
+# POSIX guarantees that appends of at most PIPE_BUF bytes are not interleaved
+_ATOMIC_APPEND_SIZE = 4096
+# bytes before the parsed offset kept in the resume index to detect rewritten output files
+_RESUME_TAIL_SIZE = 256
+
+
+def _has_non_finite_float(obj) -> bool:
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite_float(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite_float(v) for v in obj)
+    return False
+
+
+def _dumps(item: dict) -> bytes:
+    if orjson is not None:
+        try:
+            line = orjson.dumps(item)
+            # orjson writes NaN and Infinity as null, keep them as the stdlib does
+            if b"null" not in line or not _has_non_finite_float(item):
+                return line
+        except TypeError:
+            # e.g. non-str keys or integers over 64 bits, let the stdlib handle them
+            pass
+    return json.dumps(item, ensure_ascii=False).encode("utf-8")
+
+
+def _loads(line: bytes) -> dict:
+    # orjson reads integers wider than 64 bits as floats, leave lines that may hold one to the stdlib
+    if orjson is not None and _LONG_DIGIT_RUN.search(line) is None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # e.g. NaN or Infinity, which the stdlib writes and orjson rejects
+            pass
+    return json.loads(line)
 
 
 def read_jsonl(path: str) -> List[dict]:
@@ -11,9 +69,9 @@ def read_jsonl(path: str) -> List[dict]:
         raise FileNotFoundError(f"File `{path}` does not exist.")
     elif not path.endswith(".jsonl"):
         raise ValueError(f"File `{path}` is not a jsonl file.")
-    with jsonlines.open(path) as reader:
-        items = [item for item in reader]
-    return items
+    with open(path, "rb") as f:
+        data = f.read()
+    return [_loads(line) for line in data.splitlines() if line.strip()]
 
 
 def read_jsonl_map(path: str) -> List[dict]:
@@ -21,25 +79,100 @@ def read_jsonl_map(path: str) -> List[dict]:
         raise FileNotFoundError(f"File `{path}` does not exist.")
     elif not path.endswith(".jsonl"):
         raise ValueError(f"File `{path}` is not a jsonl file.")
-    items = {}
-    with jsonlines.open(path) as reader:
-        for item in reader:
-            items[item["task_id"]] = item
-    return items
+    with open(path, "rb") as f:
+        data = f.read()
+    items = (_loads(line) for line in data.splitlines() if line.strip())
+    return {item["task_id"]: item for item in items}
 
 
 def write_jsonl(path: str, data: List[dict], append: bool = False):
-    with jsonlines.open(path, mode="a" if append else "w") as writer:
-        for item in data:
-            writer.write(item)
+    with open(path, "ab" if append else "wb", buffering=_WRITE_BUFFER_SIZE) as f:
+        f.writelines(_dumps(item) + b"\n" for item in data)
 
 
-def read_jsonl_gz(path: str) -> List[dict]:
+def open_jsonl_append_fd(path: str) -> int:
+    return os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+def _write_all(fd: int, buf: bytes):
+    written = os.write(fd, buf)
+    if written != len(buf):
+        raise OSError(f"Short write to jsonl file: {written} of {len(buf)} bytes.")
+
+
+def append_jsonl_atomic(fd: int, data: List[dict]) -> List[bytes]:
+    """Append `data` to `fd`, opened by `open_jsonl_append_fd`, without any lock.
+
+    Whole records are grouped into single `write`s of at most `_ATOMIC_APPEND_SIZE` bytes,
+    which concurrent writers cannot interleave. A record larger than that is not written;
+    its serialized line is returned so that the caller can write it under a lock.
+    """
+    oversized, group, group_size = [], [], 0
+    for item in data:
+        line = _dumps(item) + b"\n"
+        if len(line) > _ATOMIC_APPEND_SIZE:
+            oversized.append(line)
+            continue
+        if group_size + len(line) > _ATOMIC_APPEND_SIZE:
+            _write_all(fd, b"".join(group))
+            group, group_size = [], 0
+        group.append(line)
+        group_size += len(line)
+    if group:
+        _write_all(fd, b"".join(group))
+    return oversized
+
+
+class JsonlAppender:
+    """Keep a jsonl file open in append mode so that records can be written one at a time
+    without reopening the file.
+
+    Usage:
+        with JsonlAppender(path) as appender:
+            appender.write(item)
+    """
+
+    def __init__(self, path: str, buffering: int = _WRITE_BUFFER_SIZE):
+        self.path = path
+        self.buffering = buffering
+        self._f = None
+
+    def __enter__(self) -> "JsonlAppender":
+        self._f = open(self.path, "ab", buffering=self.buffering)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, item: dict):
+        self.write_line(_dumps(item))
+
+    def write_line(self, line: bytes):
+        # `line` is a record already serialized by `_dumps`
+        self._f.write(line + b"\n")
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def iter_jsonl_gz(path: str) -> Iterator[dict]:
     if not path.endswith(".jsonl.gz"):
         raise ValueError(f"File `{path}` is not a jsonl.gz file.")
-    with gzip.open(path, "rt") as f:
-        data = [json.loads(line) for line in f]
-    return data
+    # decompress in binary mode, lines are decoded by `_loads` without going through a text codec
+    with _gzip.open(path, "rb") as gz:
+        reader = io.BufferedReader(gz, buffer_size=_READ_BUFFER_SIZE)
+        for line in reader:
+            if line.strip():
+                yield _loads(line)
+
+
+def read_jsonl_gz(path: str) -> List[dict]:
+    return list(iter_jsonl_gz(path))
 
 
 def json2jsonl(json_path: str, jsonl_path: str):
@@ -47,46 +180,202 @@ def json2jsonl(json_path: str, jsonl_path: str):
         data = json.load(f)
     write_jsonl(jsonl_path, data)
 
+def _read_tail(path: str, offset: int) -> bytes:
+    # the bytes of `path` right before `offset`, to detect a rewritten output file
+    with open(path, "rb") as f:
+        f.seek(max(0, offset - _RESUME_TAIL_SIZE))
+        return f.read(offset - f.tell())
+
+
+def read_resume_ids(output_path: str, identifier_key: str) -> Set:
+    """Return the set of `identifier_key` values of the records in `output_path`.
+
+    The ids are cached in `output_path + ".resume.idx"` together with the size, mtime and
+    parsed offset of the output file, so that resuming an append-only output only parses
+    the records written since the last call.
+    """
+    index_path = output_path + ".resume.idx"
+    stat = os.stat(output_path)
+    index = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "rb") as f:
+                index = pickle.load(f)
+        except Exception:
+            index = {}
+
+    ids, offset = set(), 0
+    entry = index.get(identifier_key)
+    if entry is not None and entry["offset"] <= stat.st_size:
+        if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["ids"]
+        if _read_tail(output_path, entry["offset"]) == entry["tail"]:
+            ids, offset = entry["ids"], entry["offset"]
+
+    with open(output_path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # the last record may still be being written, parse it again next time
+                try:
+                    ids.add(_loads(line)[identifier_key])
+                except ValueError:
+                    pass
+                break
+            offset += len(line)
+            if line.strip():
+                ids.add(_loads(line)[identifier_key])
+    tail = _read_tail(output_path, offset)
+
+    index[identifier_key] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "offset": offset,
+        "tail": tail,
+        "ids": ids,
+    }
+    try:
+        with open(index_path + ".tmp", "wb") as f:
+            pickle.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+    except OSError:
+        # the index is only a cache
+        pass
+    return ids
+
+
+def _enumerate_from(dataset, start_index: int):
+    # sequences are indexed directly, so that the items before `start_index` are not iterated
+    if isinstance(dataset, Sequence):
+        return ((i, dataset[i]) for i in range(start_index, len(dataset)))
+    return islice(enumerate(dataset), start_index, None)
+
+
+def _read_resume_cursor(output_path: str, dataset, identifier_key: str) -> int:
+    # the cursor is only trusted if the output file still starts with the bytes it was computed
+    # from and the item before it is still the one that was recorded
+    cursor_path = output_path + ".cursor"
+    if not isinstance(dataset, Sequence) or not os.path.exists(cursor_path):
+        return 0
+    try:
+        with open(cursor_path, "r") as f:
+            cursor = json.load(f)
+        index = cursor["index"]
+        if (
+            cursor["identifier_key"] == identifier_key
+            and 0 < index <= len(dataset)
+            and os.path.getsize(output_path) >= cursor["size"]
+            and _read_tail(output_path, cursor["size"]).hex() == cursor["tail"]
+            and dataset[index - 1][identifier_key] == cursor["last_id"]
+        ):
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return 0
+
+
+def _write_resume_cursor(output_path: str, identifier_key: str, index: int, last_id, size: int):
+    try:
+        cursor = {
+            "identifier_key": identifier_key,
+            "index": index,
+            "last_id": last_id,
+            "size": size,
+            "tail": _read_tail(output_path, size).hex(),
+        }
+        with open(output_path + ".cursor.tmp", "w") as f:
+            json.dump(cursor, f)
+        os.replace(output_path + ".cursor.tmp", output_path + ".cursor")
+    except (OSError, TypeError):
+        # the cursor is only a cache
+        pass
+
+
+def clear_resume_state(output_path: str):
+    # the resume index and cursor describe an output file that no longer exists
+    for path in (output_path + ".resume.idx", output_path + ".cursor"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def enumerate_unprocessed(
+    dataset: List[dict],
+    output_path: str,
+    identifier_key: str,
+    exist_items: Set,
+    start_index: Optional[int] = None,
+):
+    """Enumerate the items of `dataset` whose `identifier_key` is not in `exist_items`.
+
+    Items before `start_index` are assumed processed and are not scanned. By default, scanning
+    starts at the cursor that a previous call saved in `output_path + ".cursor"`: the index up
+    to which every item was already in the output file.
+    """
+    if start_index is None:
+        start_index = _read_resume_cursor(output_path, dataset, identifier_key)
+    output_size = os.path.getsize(output_path)
+    next_index, last_id = start_index, None
+    for i, item in _enumerate_from(dataset, start_index):
+        # skip items that have been processed before
+        if item[identifier_key] in exist_items:
+            if i == next_index:
+                next_index, last_id = i + 1, item[identifier_key]
+            continue
+        yield i, item
+    if last_id is not None:
+        _write_resume_cursor(output_path, identifier_key, next_index, last_id, output_size)
+
+
 # enumerate dataset and resume from output_path if it exists
 def enumerate_resume(
     dataset: List[dict],
     output_path: str,
     identifier_key: str = "task_id",
+    start_index: Optional[int] = None,
 ):
     if not os.path.exists(output_path):
-        for i, item in enumerate(dataset):
+        clear_resume_state(output_path)
+        for i, item in _enumerate_from(dataset, start_index or 0):
             yield i, item
     else:
-        exist_items = []
-        with jsonlines.open(output_path) as reader:
-            for item in reader:
-                exist_items.append(item[identifier_key])
-
-        for i, item in enumerate(dataset):
-            # skip items that have been processed before
-            if item[identifier_key] in exist_items:
-                continue
-            yield i, item
+        exist_items = read_resume_ids(output_path, identifier_key)
+        yield from enumerate_unprocessed(
+            dataset, output_path, identifier_key, exist_items, start_index
+        )
 
 import concurrent.futures
 from tqdm import tqdm
 
-def read_all_jsonl_files(input_paths, n_workers: int = 8):
-    all_data = []
+def _read_jsonl_or_exception(input_path: str):
+    try:
+        return read_jsonl(input_path), None
+    except Exception as exc:
+        return None, exc
+
+
+def _iter_all_jsonl_files(input_paths, n_workers: int):
+    input_paths = list(input_paths)
+    num_entries = 0
 
-    # Create a ThreadPoolExecutor
+    # Create a ThreadPoolExecutor, worker processes would have to pickle every entry back,
+    # which costs more than parsing it
     with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
-        # Submit reading tasks for all input files
-        future_to_file = {executor.submit(read_jsonl, input_path): input_path for input_path in input_paths}
+        results = executor.map(_read_jsonl_or_exception, input_paths)
 
         # Use tqdm to show progress
-        for future in tqdm(concurrent.futures.as_completed(future_to_file), total=len(input_paths), desc="Reading files"):
-            file_path = future_to_file[future]
-            try:
-                data = future.result()
-                all_data.extend(data)
-            except Exception as exc:
+        for file_path, (data, exc) in tqdm(zip(input_paths, results), total=len(input_paths), desc="Reading files"):
+            if exc is not None:
                 print(f'{file_path} generated an exception: {exc}')
+                continue
+            num_entries += len(data)
+            yield from data
+
+    print(f"Total number of entries in the dataset: {num_entries}")
+
 
-    print(f"Total number of entries in the dataset: {len(all_data)}")
-    return all_data
+def read_all_jsonl_files(input_paths, n_workers: int = 8, as_iterator: bool = False):
+    # with `as_iterator`, entries are yielded file by file instead of being collected in one list
+    all_data = _iter_all_jsonl_files(input_paths, n_workers)
+    if as_iterator:
+        return all_data
+    return list(all_data)
@@ -1,8 +1,7 @@
-from litellm import completion
 from datetime import datetime
-import openai
-import litellm
 from .print_utils import make_printv
+import asyncio
+import random
 import time
 
 print_v = make_printv(True)
@@ -20,6 +19,29 @@ class CompletionFailedException(Exception):
     pass
 
 
+def _retry_delay(e: Exception, attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    # honor the `Retry-After` header of rate limit responses, otherwise back off exponentially with jitter
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0.0, min(cap, float(retry_after)))
+        except ValueError:
+            pass
+    return min(cap, base * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+def _prepare_request(llm_provider: str, llm_model: str, user_prompt: str, system_prompt: str):
+    if llm_provider is not None:
+        litellm_model = f"{llm_provider}/{llm_model}"
+    else:
+        litellm_model = llm_model
+    messages = [{"role": "user", "content": user_prompt}]
+    if system_prompt is not None:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+    return litellm_model, messages
+
+
 def get_response(
     llm_provider: str,
     llm_model: str,
@@ -31,16 +53,14 @@ def get_response(
     timeout: int = 60,
     system_prompt: str = None,
 ):
-    if llm_provider is not None:
-        litellm_model = f"{llm_provider}/{llm_model}"
-    else:
-        litellm_model = llm_model
-    messages = [{"role": "user", "content": user_prompt}]
-    if system_prompt is not None:
-        messages.insert(0, {"role": "system", "content": system_prompt})
-    for _ in range(max_attempts):
+    # litellm and openai take long to import, so they are only imported on first use
+    import litellm
+    import openai
+
+    litellm_model, messages = _prepare_request(llm_provider, llm_model, user_prompt, system_prompt)
+    for attempt in range(max_attempts):
         try:
-            response = completion(
+            response = litellm.completion(
                 model=litellm_model,
                 messages=messages,
                 max_tokens=llm_max_token,
@@ -48,9 +68,47 @@ def get_response(
                 temperature=llm_temperature,
             )
             return response
-        except litellm.exceptions.RateLimitError as e:
+        except (litellm.exceptions.RateLimitError, openai.APITimeoutError) as e:
+            if attempt + 1 < max_attempts:
+                time.sleep(_retry_delay(e, attempt))
             continue
-        except openai.APITimeoutError as e:
+        except Exception as e:
+            raise e
+
+    raise CompletionFailedException(
+        f"Failed to get completion for {completion_identifier} after {max_attempts} attempts. Exiting"
+    )
+
+
+async def aget_response(
+    llm_provider: str,
+    llm_model: str,
+    llm_max_token: int,
+    llm_temperature: float,
+    user_prompt: str,
+    completion_identifier: str,
+    max_attempts: int = 10,
+    timeout: int = 60,
+    system_prompt: str = None,
+):
+    """Async version of `get_response`, so that one event loop can keep many requests in flight."""
+    import litellm
+    import openai
+
+    litellm_model, messages = _prepare_request(llm_provider, llm_model, user_prompt, system_prompt)
+    for attempt in range(max_attempts):
+        try:
+            response = await litellm.acompletion(
+                model=litellm_model,
+                messages=messages,
+                max_tokens=llm_max_token,
+                timeout=timeout,  # raise timeout error if call takes > 60s
+                temperature=llm_temperature,
+            )
+            return response
+        except (litellm.exceptions.RateLimitError, openai.APITimeoutError) as e:
+            if attempt + 1 < max_attempts:
+                await asyncio.sleep(_retry_delay(e, attempt))
             continue
         except Exception as e:
             raise e
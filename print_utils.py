@@ -1,12 +1,17 @@
+def _print_v(*args, **kwargs):
+    kwargs["flush"] = True
+    print(*args, **kwargs)
+
+
+def NOOP(*args, **kwargs):
+    pass
+
+
+# Returns `NOOP` when `verbose` is False, so callers can skip building messages with
+# `if print_v is not NOOP:`.
 def make_printv(verbose: bool):
-    def print_v(*args, **kwargs):
-        if verbose:
-            kwargs["flush"] = True
-            print(*args, **kwargs)
-        else:
-            pass
-    return print_v
+    return _print_v if verbose else NOOP
 
 if __name__ == "__main__":
     print_v = make_printv(True)
-    print_v("Hello, world!")
\ No newline at end of file
+    print_v("Hello, world!")
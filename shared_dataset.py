@@ -0,0 +1,89 @@
+from typing import *
+from array import array
+from multiprocessing import shared_memory
+import struct
+
+from llm_utils.jsonl_utils import _dumps, _loads
+
+# [number of items: uint64][offsets: (number of items + 1) * uint64][jsonl payload]
+_HEADER = struct.Struct("Q")
+_OFFSET_SIZE = 8
+
+
+class SharedJsonlDataset(Sequence):
+    """A read-only list of json serializable dicts, stored as jsonl in one shared memory block.
+
+    Items are parsed on access, so a worker process only holds the items it works on. Python
+    objects shared through fork are copied page by page as soon as their refcount changes,
+    while the shared block is never written after creation.
+
+    Usage:
+        with SharedJsonlDataset.from_items(dataset) as shared_dataset:
+            # pass `shared_dataset` to workers, it is pickled as its shared memory name
+            ...
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self._shm = shm
+        self._owner = owner
+        (self._len,) = _HEADER.unpack_from(shm.buf, 0)
+        self._payload_start = _HEADER.size + (self._len + 1) * _OFFSET_SIZE
+        self._offsets = shm.buf[_HEADER.size : self._payload_start].cast("Q")
+
+    @classmethod
+    def from_items(cls, items: Sequence[dict]) -> "SharedJsonlDataset":
+        # items are serialized twice, once to size the block and once straight into it,
+        # so that the whole payload is never held outside the block
+        offsets = array("Q", [0])
+        for item in items:
+            offsets.append(offsets[-1] + len(_dumps(item)))
+        payload_start = _HEADER.size + len(offsets) * _OFFSET_SIZE
+        shm = shared_memory.SharedMemory(create=True, size=payload_start + offsets[-1])
+        _HEADER.pack_into(shm.buf, 0, len(offsets) - 1)
+        shm.buf[_HEADER.size : payload_start] = offsets.tobytes()
+        for item, offset, end in zip(items, offsets, offsets[1:]):
+            line = _dumps(item)
+            if len(line) != end - offset:
+                shm.close()
+                shm.unlink()
+                raise ValueError("Items changed while being copied into shared memory.")
+            shm.buf[payload_start + offset : payload_start + end] = line
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedJsonlDataset":
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def __reduce__(self):
+        return SharedJsonlDataset.attach, (self.name,)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._len))]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("SharedJsonlDataset index out of range")
+        start = self._payload_start + self._offsets[index]
+        end = self._payload_start + self._offsets[index + 1]
+        return _loads(bytes(self._shm.buf[start:end]))
+
+    def close(self):
+        # views into the block must be released before it can be closed
+        self._offsets.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __enter__(self) -> "SharedJsonlDataset":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()